@@ -1,131 +1,880 @@
 import os
-import json
+import re
 import time
-from glob import glob
+import atexit
+import pickle
+import hashlib
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from bisect import bisect_left
+from functools import lru_cache
+from math import prod
 from pathlib import Path
 from termcolor import colored
-
-from pytket import Circuit
-from pytket.qasm import circuit_from_qasm_str
-from pytket.extensions.cutensornet import TensorNetwork
-import cuquantum as cq
+import orjson
 import numpy as np
 
+# pytket, cupy and cuquantum take seconds to import, so they are only imported
+# in the functions that use them. This keeps the CLI startup and the circuit
+# loading workers fast.
 
-def test_equivalence(circ1, circ2):
-    n_qubits = circ1.n_qubits
-    assert n_qubits == circ2.n_qubits
+# Classical register declarations, stripped from qasm inputs
+_CREG_RE = re.compile(r"^\s*creg\b[^;]*;[ \t]*\n?", re.MULTILINE)
+# Quantum register declarations, capturing their size. Several may share a line
+_QREG_RE = re.compile(r"\bqreg\s+\w+\s*\[\s*(\d+)\s*\]\s*;")
+
+# Autotuning iterations used to pick the cuTENSOR kernel of each pairwise
+# contraction, for networks reused by several batches of candidates
+autotune_iterations = 3
+
+# Precision of the contractions. The overlap of equivalent circuits is
+# compared against 1 with `atol`, well above complex64 rounding errors
+dtype = np.complex64
+atol = 1e-4
+
+# Maximum number of candidates stacked into a single network
+batch_size = 16
+# Number of slices of a sliced network contracted between early-exit checks
+slice_chunk = 16
+# Fraction of the slices contracted before a sliced network may be given up
+early_exit_fraction = 0.5
+
+# Directory where optimized contraction paths are kept between runs
+path_cache_dir = (
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "check-circ-eq"
+)
+
+
+@lru_cache
+def network_options():
+    """Options shared by all the networks.
+
+    They hold a single cuTensorNet handle, created on first use and shared by
+    every contraction in the process. Contractions of GPU operands do not
+    block the host.
+
+    Networks are sliced so that their workspace fits in 40% of the device
+    memory. The network being contracted and the next one, prepared on a
+    worker thread meanwhile, are alive at the same time, so each gets half
+    of cuQuantum's default 80% limit.
+    """
+    import cuquantum as cq
+    from cuquantum import cutensornet as cutn
+
+    handle = cutn.create()
+    atexit.register(cutn.destroy, handle)
+    return cq.NetworkOptions(handle=handle, memory_limit="40%", blocking="auto")
+
+
+@lru_cache
+def optimizer_options():
+    """Pathfinder configuration, reused by all the networks.
+
+    The path is reconfigured after slicing to recover the FLOPs it costs.
+    """
+    import cuquantum as cq
+    from cuquantum import cutensornet as cutn
+
+    return cq.OptimizerOptions(
+        slicing=cq.SlicerOptions(
+            memory_model=cutn.MemoryModel.CUTENSOR, min_slices=1, slice_factor=2
+        ),
+        reconfiguration=cq.ReconfigOptions(num_iterations=500, num_leaves=8),
+    )
+
+
+def _structure(operands):
+    """Key identifying the modes and tensor shapes of an interleaved network."""
+    return tuple(
+        (op.shape, op.dtype) if hasattr(op, "shape") else tuple(op)
+        for op in operands
+    )
+
+
+def find_path(net, structure):
+    """Find the contraction path of `net`, whose `_structure` is `structure`.
+
+    Paths and slicings are cached on disk keyed by the network structure, the
+    memory limit the slicing was fitted to and the pathfinder configuration,
+    so networks seen in a previous run skip the optimizer entirely. Returns
+    the `OptimizerInfo` of the path.
+    """
+    import cuquantum as cq
+
+    key = (structure, net.memory_limit, optimizer_options())
+    fingerprint = hashlib.sha256(repr(key).encode()).hexdigest()
+    path_file = path_cache_dir / f"path_{fingerprint}.pkl"
+
+    if path_file.exists():
+        with open(path_file, "rb") as f:
+            path, slices = pickle.load(f)
+        optimize = cq.OptimizerOptions(path=path, slicing=slices)
+        return net.contract_path(optimize=optimize)[1]
+
+    _, info = net.contract_path(optimize=optimizer_options())
+
+    path_cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = path_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_file, "wb") as f:
+        pickle.dump((list(info.path), list(info.slices)), f)
+    os.replace(tmp_file, path_file)
+    return info
+
+
+def contract(*operands):
+    """Contract a network in interleaved format using the shared handle."""
+    import cuquantum as cq
+
+    with cq.Network(*operands, options=network_options()) as net:
+        find_path(net, _structure(operands))
+        return net.contract()
+
+
+@lru_cache
+def _bell_states(n_qubits):
+    """Circuit preparing `n_qubits` bell pairs, shared by every caller.
+
+    The returned circuit must not be modified; copy it before adding gates.
+    """
+    from pytket import Circuit
 
     bell_states = Circuit(2 * n_qubits)
     for q in range(n_qubits):
         bell_states.H(q)
     for q in range(n_qubits):
         bell_states.CX(q, q + n_qubits)
+    return bell_states
+
+
+# The "bra" side of the overlap networks of a reference circuit: its
+# interleaved operands, and the open mode of each qubit
+_Bra = namedtuple("_Bra", ["operands", "sticky_indices"])
+
+
+def prepare_bra(old_circ):
+    """Get the bell-state prefix and build the "bra" TN of the reference circuit.
+
+    The bra is built directly as the adjoint TN, once per reference, and its
+    operands are cast to `dtype` and their parallel modes fused there, so
+    that candidates only pay for their own side. The result can be reused to
+    check any number of candidate circuits against `old_circ` with
+    `check_against`.
+    """
+    from pytket.extensions.cutensornet import TensorNetwork
+
+    n_qubits = old_circ.n_qubits
+    bell_states = _bell_states(n_qubits)
+
+    bra_circ = bell_states.copy()
+    bra_circ.add_circuit(old_circ, qubits=list(range(n_qubits)))
+    bra_tn = TensorNetwork(bra_circ, adj=True)
+    operands = list(bra_tn.cuquantum_interleaved)
+    for i in range(0, len(operands), 2):
+        operands[i] = operands[i].astype(dtype, copy=False)
+    bra_net = _Bra(fuse_parallel_modes(operands), bra_tn.sticky_indices)
+
+    return bell_states, bra_net
+
 
+def overlap_network(bra_net, bell_states, new_circ):
+    """Build the overlap TN of `new_circ` with a reference from `prepare_bra`.
+
+    The network is returned in cuQuantum's interleaved format, with the
+    tensors of the reference side first, followed by the unit matrices
+    joining the two sides and the tensors of the candidate. The two sides
+    only share the modes of the unit matrices, so parallel modes are only
+    fused on the candidate's side.
+    """
+    from pytket.extensions.cutensornet import TensorNetwork
+
+    n_qubits = new_circ.n_qubits
+    assert 2 * n_qubits == bell_states.n_qubits
+
+    # `add_circuit` works in place, so the shared prefix is copied once here
     ket_circ = bell_states.copy()
-    ket_circ.add_circuit(circ1, qubits=[q for q in range(n_qubits)])
-    bra_circ = bell_states
-    bra_circ.add_circuit(circ2, qubits=[q for q in range(n_qubits)])
+    ket_circ.add_circuit(new_circ, qubits=list(range(n_qubits)))
 
-    # Create the TNs of the circuits
+    # Create the TN of the candidate circuit
     ket_net = TensorNetwork(ket_circ)
-    bra_net = TensorNetwork(bra_circ)
-    # Concatenate one with the other, netB is the adjoint
-    overlap_net = ket_net.vdot(bra_net)
-    # Run the contraction
-    overlap = cq.contract(*overlap_net)
+    if set(ket_net.sticky_indices) != set(bra_net.sticky_indices):
+        raise RuntimeError("The two tensor networks are incompatible!")
+
+    # Concatenate the adjoint with the candidate as `TensorNetwork.vdot` does,
+    # joining their open wires with unit matrices, but without rebuilding the
+    # adjoint
+    ket_side = []
+    for q, ket_index in ket_net.sticky_indices.items():
+        ket_side += [np.eye(2, dtype=dtype), [bra_net.sticky_indices[q], ket_index]]
+    ket_side += ket_net.cuquantum_interleaved
+    for i in range(0, len(ket_side), 2):
+        ket_side[i] = ket_side[i].astype(dtype, copy=False)
+    return bra_net.operands + fuse_parallel_modes(ket_side)
+
+
+def fuse_parallel_modes(operands):
+    """Fuse the modes shared by the same pair of tensors into a single mode.
+
+    Parallel edges between two tensors are merged by reshaping both of them,
+    leaving fewer but wider modes in the interleaved network `operands`. The
+    order and number of tensors is unchanged. Open modes, and modes appearing
+    in more than two tensors or twice in the same one, are left untouched.
+    """
+    n_tensors = len(operands) // 2
+    tensors = list(operands[: 2 * n_tensors : 2])
+    modes = [list(m) for m in operands[1 : 2 * n_tensors : 2]]
+    output = operands[2 * n_tensors :]
+    open_modes = set(output[0]) if output else set()
+
+    owners = defaultdict(list)
+    for t, tensor_modes in enumerate(modes):
+        for m in tensor_modes:
+            owners[m].append(t)
+    parallel = defaultdict(list)
+    for m, ts in owners.items():
+        if len(ts) == 2 and ts[0] != ts[1] and m not in open_modes:
+            parallel[tuple(ts)].append(m)
+
+    for pair, group in parallel.items():
+        if len(group) < 2:
+            continue
+        for t in pair:
+            rest = [m for m in modes[t] if m not in group]
+            axes = [modes[t].index(m) for m in group + rest]
+            extents = [tensors[t].shape[axis] for axis in axes]
+            fused = prod(extents[: len(group)])
+            tensors[t] = (
+                tensors[t].transpose(axes).reshape(fused, *extents[len(group) :])
+            )
+            modes[t] = [group[0], *rest]
+
+    fused_operands = []
+    for tensor, tensor_modes in zip(tensors, modes):
+        fused_operands += [tensor, tensor_modes]
+    return fused_operands + output
+
+
+def check_against(bra_net, bell_states, new_circ):
+    """Check `new_circ` against a reference prepared with `prepare_bra`."""
+    overlap = contract(*overlap_network(bra_net, bell_states, new_circ))
+    return np.isclose(overlap, 1, atol=atol)
+
+
+def test_equivalence(circ1, circ2):
+    assert circ1.n_qubits == circ2.n_qubits
+    bell_states, bra_net = prepare_bra(circ2)
+    return check_against(bra_net, bell_states, circ1)
+
+
+def _circuit_key(circ):
+    """Cheap key for the structure of the overlap network of `circ`.
+
+    The structure only depends on the sequence of qubits the gates act on, so
+    candidates with the same key can almost always be stacked, and the key is
+    found without building their networks.
+    """
+    return tuple(tuple(cmd.qubits) for cmd in circ.get_commands())
+
+
+def stack_networks(overlap_nets):
+    """Stack interleaved networks of equal structure along a new batch mode.
+
+    Operands that are equal in every network are shared, the others are
+    stacked with the batch mode as their leading axis. The batch mode is the
+    only open mode, so the contraction yields the vector of overlaps. If the
+    networks are all identical, as for duplicate candidates, the last operand
+    is stacked anyway so that the batch mode still appears in an input.
+    """
+    first = overlap_nets[0]
+    n_tensors = len(first) // 2
+    batch_mode = max(m for modes in first[1::2] for m in modes) + 1
+
+    stacked = []
+    any_stacked = False
+    for i in range(n_tensors):
+        tensors = [net[2 * i] for net in overlap_nets]
+        modes = list(first[2 * i + 1])
+        is_last = i == n_tensors - 1
+        if (any_stacked or not is_last) and all(
+            np.array_equal(tensors[0], t) for t in tensors[1:]
+        ):
+            stacked += [tensors[0], modes]
+        else:
+            stacked += [np.stack(tensors), [batch_mode, *modes]]
+            any_stacked = True
+    stacked.append([batch_mode])
+    return stacked
+
+
+# Alignment of the arrays packed together by `_to_device`, in bytes, matching
+# that of CUDA allocations
+_ALIGNMENT = 256
+
+
+def _to_device(arrays, stream):
+    """Copy `arrays` to the GPU through a single page-locked staging buffer.
+
+    The arrays are packed into one pinned allocation and copied with one
+    asynchronous transfer on `stream`. Returns the device arrays, views into
+    a single device buffer, and the staging buffer, which must be kept alive
+    until the stream has caught up with the copy.
+    """
+    import cupy as cp
+
+    offsets = []
+    nbytes = 0
+    for array in arrays:
+        offsets.append(nbytes)
+        nbytes += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+
+    def views(buffer):
+        return [
+            buffer[offset : offset + array.nbytes]
+            .view(array.dtype)
+            .reshape(array.shape)
+            for array, offset in zip(arrays, offsets)
+        ]
+
+    staging = np.frombuffer(cp.cuda.alloc_pinned_memory(nbytes), np.uint8, nbytes)
+    for view, array in zip(views(staging), arrays):
+        view[...] = array
+    with stream:
+        device = cp.empty(nbytes, np.uint8)
+    device.set(staging, stream=stream)
+    return views(device), staging
+
+
+# A batch ready to be contracted, see `OverlapContractor._prepare`
+_Prepared = namedtuple(
+    "_Prepared",
+    [
+        "batch",
+        "structure",
+        "net",
+        "num_slices",
+        "tensors",
+        "staging",
+        "ready",
+        "tune_events",
+        "elapsed_time",
+    ],
+)
+
+
+class OverlapContractor:
+    """Contracts the overlap networks of candidates against a reference circuit.
+
+    Candidates whose networks share a structure are stacked with
+    `stack_networks` and contracted together, up to `batch_size` at a time.
+
+    The `Network` is kept alive between batches. When a batch yields a
+    network with the same structure as the previous one, only its operands
+    are swapped in with `reset_operands`, so its contraction path is reused.
+    Networks are only autotuned when their structure spans several batches,
+    as autotuning costs a few full contractions.
+
+    Contractions run on a dedicated non-blocking CUDA stream, while the next
+    batch's network is built, its operands copied to the GPU and its path
+    found on a worker thread. The copies, and the autotuning of new
+    networks, run on streams of their own, so they do not queue behind or
+    into the current contraction, and the contraction stream waits for them
+    through an event. The operands of the reference side, shared by every
+    candidate, are only copied once.
+    """
+
+    def __init__(self, old_circ):
+        import cupy as cp
+
+        self.old_circ = old_circ
+        self.stream = cp.cuda.Stream(non_blocking=True)
+        self.copy_stream = cp.cuda.Stream(non_blocking=True)
+        self.tune_stream = cp.cuda.Stream(non_blocking=True)
+        # Built lazily, so references with no checked candidate never pay for it
+        self.bra = None
+        # Device operands of the reference side, and their staging buffer
+        self.reference_tensors = None
+        self.reference_staging = None
+        self.net = None
+        self.structure = None
+        self.num_slices = 1
+
+    def free(self):
+        if self.net is not None:
+            # The network may still be in use by queued contractions
+            self.stream.synchronize()
+            self.net.free()
+        self.net = None
+        self.structure = None
+        self.num_slices = 1
+        self.reference_tensors = None
+        self.reference_staging = None
 
-    return np.isclose(overlap, 1)
+    def _build(self, new_circ):
+        """Build the overlap network of `new_circ`, and time it."""
+        start_time = time.perf_counter()
+        if self.bra is None:
+            self.bra = prepare_bra(self.old_circ)
+        bell_states, bra_net = self.bra
+        overlap_net = overlap_network(bra_net, bell_states, new_circ)
+        return overlap_net, time.perf_counter() - start_time
 
+    def _prepare(self, new_circs, batch, autotune, structure):
+        """Build the overlap networks of a batch, stack them and find the path.
 
-def run(max_qubits, results):
+        `batch` holds the indices of candidates in `new_circs` that share a
+        `_circuit_key`. Their networks are split by structure in the rare
+        case they differ, and one `_Prepared` is returned per structure.
+
+        No `Network` is created for a structure equal to the one before it,
+        starting with `structure`, as that network will be reused. New
+        networks are autotuned if `autotune` is set. The current network is
+        not touched, so this can run while it is being contracted.
+        """
+        import cupy as cp
+        import cuquantum as cq
+
+        by_structure = {}
+        for i in batch:
+            overlap_net, build_time = self._build(new_circs[i])
+            members = by_structure.setdefault(_structure(overlap_net), [])
+            members.append((i, overlap_net, build_time))
+
+        prepared = []
+        for members in by_structure.values():
+            sub_batch, overlap_nets, build_times = zip(*members)
+            start_time = time.perf_counter()
+            if len(overlap_nets) == 1:
+                overlap_net = list(overlap_nets[0])
+            else:
+                overlap_net = stack_networks(overlap_nets)
+
+            n_tensors = len(overlap_net) // 2
+            previous_structure, structure = structure, _structure(overlap_net)
+
+            # The reference adjoint and the unit matrices joining it to the
+            # candidates lead every network, and are never stacked
+            _, bra_net = self.bra
+            n_reference = len(bra_net.operands) // 2
+            n_reference += len(bra_net.sticky_indices)
+            tensors = overlap_net[: 2 * n_tensors : 2]
+            if self.reference_tensors is None:
+                self.reference_tensors, self.reference_staging = _to_device(
+                    tensors[:n_reference], self.copy_stream
+                )
+            candidate_tensors, staging = _to_device(
+                tensors[n_reference:], self.copy_stream
+            )
+            tensors = self.reference_tensors + candidate_tensors
+            overlap_net[: 2 * n_tensors : 2] = tensors
+            ready = cp.cuda.Event(disable_timing=True)
+            ready.record(self.copy_stream)
+
+            net = None
+            num_slices = None
+            tune_events = None
+            if structure != previous_structure:
+                net = cq.Network(
+                    *overlap_net, options=network_options(), stream=self.stream
+                )
+                num_slices = find_path(net, structure).num_slices
+                if autotune:
+                    # Timed on its own stream, and added to this batch's time
+                    tune_events = (cp.cuda.Event(), cp.cuda.Event())
+                    self.tune_stream.wait_event(ready)
+                    tune_events[0].record(self.tune_stream)
+                    net.autotune(
+                        iterations=autotune_iterations, stream=self.tune_stream
+                    )
+                    tune_events[1].record(self.tune_stream)
+                    ready = tune_events[1]
+
+            elapsed_time = sum(build_times) + time.perf_counter() - start_time
+            prepared.append(
+                _Prepared(
+                    sub_batch,
+                    structure,
+                    net,
+                    num_slices,
+                    tensors,
+                    staging,
+                    ready,
+                    tune_events,
+                    elapsed_time,
+                )
+            )
+        return prepared
+
+    def _install(self, prepared):
+        """Make the network of a `_prepare` result the current one.
+
+        Returns the network it replaces, if any. It may still be in use by
+        queued contractions, and is left to the caller to free.
+        """
+        self.stream.wait_event(prepared.ready)
+        if prepared.net is None:
+            self.net.reset_operands(*prepared.tensors, stream=self.stream)
+            return None
+
+        replaced = self.net
+        self.net = prepared.net
+        self.structure = prepared.structure
+        self.num_slices = prepared.num_slices
+        return replaced
+
+    def _contract(self):
+        """Contract the current network, giving up early on failing batches.
+
+        Returns the overlaps, and whether the contraction stopped early.
+
+        Sliced networks are contracted `slice_chunk` slices at a time. The
+        remaining chunks are assumed to contribute at most the largest chunk
+        magnitude seen so far each. Once `early_exit_fraction` of the slices
+        are contracted and a chunk of non-negligible magnitude has been seen,
+        the contraction stops as soon as no overlap in the batch can reach 1
+        under that estimate. It is not a strict bound, so the candidates of a
+        batch that stopped early are reported as inconclusive.
+
+        Unsliced networks are only queued on the stream, without waiting for
+        the result.
+        """
+        if self.num_slices <= slice_chunk:
+            return self.net.contract(stream=self.stream), False
+
+        overlaps = 0
+        max_chunk_magnitude = 0
+        for start in range(0, self.num_slices, slice_chunk):
+            stop = min(start + slice_chunk, self.num_slices)
+            partial = self.net.contract(slices=range(start, stop), stream=self.stream)
+            self.stream.synchronize()
+            overlaps = overlaps + partial
+
+            max_chunk_magnitude = max(max_chunk_magnitude, float(abs(partial).max()))
+            n_remaining = -(-(self.num_slices - stop) // slice_chunk)
+            if (
+                not n_remaining
+                or stop < early_exit_fraction * self.num_slices
+                or max_chunk_magnitude <= atol
+            ):
+                continue
+            remaining_bound = n_remaining * max_chunk_magnitude
+            if bool((abs(overlaps) + remaining_bound < 1 - atol).all()):
+                return overlaps, True
+
+        return overlaps, False
+
+    def contract_all(self, new_circs):
+        """Contract the overlap networks of the candidates `new_circs`.
+
+        Returns `(is_eq, elapsed_time, early_exit)` for each entry of
+        `new_circs`, or `(None, 0, False)` for entries that are `None`, where
+        `early_exit` tells if the candidate's contraction stopped early, which
+        leaves a failing `is_eq` inconclusive. The overlaps are compared
+        against 1 on the GPU, and the host only waits for the results once all
+        the batches are queued. The time of a batch, its preparation plus its
+        GPU time, is split evenly between its candidates.
+        """
+        import cupy as cp
+
+        new_circs = list(new_circs)
+        results = [(None, 0, False)] * len(new_circs)
+
+        # Candidates are grouped before their networks are built, which is
+        # left to the worker thread one batch at a time
+        by_key = {}
+        for i, new_circ in enumerate(new_circs):
+            if new_circ is not None:
+                by_key.setdefault(_circuit_key(new_circ), []).append(i)
+        # Batches are paired with whether their stacked structure is shared
+        # by other batches, which only full batches of a large group are
+        batches = []
+        for indices in by_key.values():
+            n_full = len(indices) // batch_size
+            for j in range(0, len(indices), batch_size):
+                batch = indices[j : j + batch_size]
+                batches.append((batch, n_full > 1 and len(batch) == batch_size))
+        if not batches:
+            return results
+
+        queued = []
+        # Networks replaced by a new structure, with the event ending their
+        # last contraction. They are freed once the stream is done with them,
+        # without waiting for it
+        replaced = []
+        end_event = None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(
+                self._prepare, new_circs, *batches[0], self.structure
+            )
+            for b in range(len(batches)):
+                prepared_batch = future.result()
+                # Start on the next batch before contracting this one
+                if b + 1 < len(batches):
+                    future = executor.submit(
+                        self._prepare,
+                        new_circs,
+                        *batches[b + 1],
+                        prepared_batch[-1].structure,
+                    )
+
+                for prepared in prepared_batch:
+                    replaced_net = self._install(prepared)
+                    if replaced_net is not None:
+                        replaced.append((replaced_net, end_event))
+                    still_used = []
+                    for net, last_event in replaced:
+                        if last_event is None or last_event.done:
+                            net.free()
+                        else:
+                            still_used.append((net, last_event))
+                    replaced = still_used
+
+                    start_event = cp.cuda.Event()
+                    end_event = cp.cuda.Event()
+                    start_event.record(self.stream)
+                    overlaps, early_exit = self._contract()
+                    end_event.record(self.stream)
+                    with self.stream:
+                        is_eq = cp.isclose(overlaps, 1, atol=atol).ravel()
+                    # Keep the prepared batch, and its staging buffers, until
+                    # the stream is synchronized
+                    queued.append(
+                        (prepared, start_event, end_event, early_exit, is_eq)
+                    )
+
+        self.stream.synchronize()
+        for net, _ in replaced:
+            net.free()
+        all_eq = cp.asnumpy(cp.concatenate([is_eq for *_, is_eq in queued]))
+
+        offset = 0
+        for prepared, start_event, end_event, early_exit, _ in queued:
+            gpu_time = cp.cuda.get_elapsed_time(start_event, end_event) / 1000
+            if prepared.tune_events is not None:
+                tune_time = cp.cuda.get_elapsed_time(*prepared.tune_events)
+                gpu_time += tune_time / 1000
+            batch_time = prepared.elapsed_time + gpu_time
+            batch = prepared.batch
+            for i, is_eq in zip(batch, all_eq[offset : offset + len(batch)]):
+                results[i] = (bool(is_eq), batch_time / len(batch), early_exit)
+            offset += len(batch)
+
+        return results
+
+
+def _load_group(old_circ_f, new_circ_fs, max_qubits):
+    """Load a reference circuit and its candidates. Runs in a worker process.
+
+    Returns `(old_circ, [(new_circ_f, n_qubits, new_circ), ...])`, or `None`
+    if the reference is not a supported circuit file. Candidates that will be
+    rejected or skipped because of their qubit count are not loaded, and
+    their `new_circ` is `None`. The qubit count read from the file only
+    decides what is loaded; that of a loaded circuit is checked again.
+    """
+    try:
+        old_circ = load_circuit(old_circ_f)
+    except ValueError:
+        return None
+
+    new_circs = []
+    for new_circ_f in new_circ_fs:
+        n_qubits, data = _read_circuit_file(new_circ_f)
+        new_circ = None
+        if n_qubits == old_circ.n_qubits and n_qubits <= max_qubits:
+            new_circ = load_circuit(new_circ_f, data)
+            n_qubits = new_circ.n_qubits
+            if n_qubits != old_circ.n_qubits:
+                new_circ = None
+        new_circs.append((new_circ_f, n_qubits, new_circ))
+    return old_circ, new_circs
+
+
+def _init_worker():
+    """Import the circuit parsers once when a loading worker starts."""
+    import pytket.qasm  # noqa: F401
+
+
+def _prefetch_groups(groups, max_qubits, max_workers=None):
+    """Load the `(old_circ_f, name, new_circ_fs)` groups in a process pool.
+
+    Yields `(old_circ_f, name, loaded)` in order, where `loaded` is the result
+    of `_load_group`. At most a couple of groups per worker are kept in
+    flight, so memory stays bounded while the GPU works on the current one.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = 2 * max_workers
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_init_worker
+    ) as executor:
+        pending = deque()
+        for old_circ_f, name, new_circ_fs in groups:
+            future = executor.submit(_load_group, old_circ_f, new_circ_fs, max_qubits)
+            pending.append((old_circ_f, name, future))
+            if len(pending) >= max_pending:
+                old_circ_f, name, future = pending.popleft()
+                yield old_circ_f, name, future.result()
+        while pending:
+            old_circ_f, name, future = pending.popleft()
+            yield old_circ_f, name, future.result()
+
+
+def _find_groups(old_circs, new_circs):
+    """List each reference circuit file with its candidate files.
+
+    The candidates of a reference `name.ext` are the json and qasm files in
+    `new_circs` whose name starts with `name`. The candidate directory is
+    scanned once, and the candidates of each reference are found by bisecting
+    the sorted file names.
+    """
+    with os.scandir(new_circs) as entries:
+        new_names = sorted(
+            entry.name for entry in entries if not entry.name.startswith(".")
+        )
+
+    for name in os.listdir(old_circs):
+        old_circ_f = os.path.join(old_circs, name)
+        name = os.path.splitext(name)[0]
+
+        json_new_circs = []
+        qasm_new_circs = []
+        i = bisect_left(new_names, name)
+        while i < len(new_names) and new_names[i].startswith(name):
+            new_name = new_names[i]
+            if new_name.endswith(".json"):
+                json_new_circs.append(os.path.join(new_circs, new_name))
+            elif new_name.endswith(".qasm"):
+                qasm_new_circs.append(os.path.join(new_circs, new_name))
+            i += 1
+
+        if not json_new_circs and not qasm_new_circs:
+            continue
+
+        yield old_circ_f, name, json_new_circs + qasm_new_circs
+
+
+def run(max_qubits, results, max_workers=None):
     old_circs = "bef"
     new_circs = "aft"
 
     n_skipped = 0
     n_success = 0
     n_fail = 0
+    n_inconclusive = 0
 
-    global_start_time = time.time()
-
-    for name in os.listdir(old_circs):
-        old_circ_f = os.path.join(old_circs, name)
-        name = Path(name).stem
+    global_start_time = time.perf_counter()
 
-        try:
-            old_circ = load_circuit(old_circ_f)
-        except ValueError:
+    groups = _find_groups(old_circs, new_circs)
+    for old_circ_f, name, loaded in _prefetch_groups(groups, max_qubits, max_workers):
+        if loaded is None:
             # Ignore this file
             # We only support tket1 json and qasm files
             continue
+        old_circ, new_circs_loaded = loaded
 
-        json_new_circs = glob(os.path.join(new_circs, name + "*.json"))
-        qasm_new_circs = glob(os.path.join(new_circs, name + "*.qasm"))
-
-        if not json_new_circs and not qasm_new_circs:
-            continue
-
-        print(
+        # Log lines are buffered and printed once per reference circuit
+        log = [
             f"Checking equivalence for {old_circ_f} ({old_circ.n_qubits} qb, {old_circ.n_gates} gates)"
-        )
+        ]
 
-        for new_circ_f in json_new_circs + qasm_new_circs:
-            new_circ = load_circuit(new_circ_f)
+        contractor = OverlapContractor(old_circ)
+        checks = contractor.contract_all(
+            new_circ for _, _, new_circ in new_circs_loaded
+        )
 
-            print(f"\t{new_circ_f} ({new_circ.n_gates} gates): ", end="")
+        for (new_circ_f, n_qubits, new_circ), (is_eq, elapsed_time, early_exit) in zip(
+            new_circs_loaded, checks
+        ):
+            if new_circ is None:
+                line = f"\t{new_circ_f}: "
+            else:
+                line = f"\t{new_circ_f} ({new_circ.n_gates} gates): "
 
-            if new_circ.n_qubits != old_circ.n_qubits:
-                print(
-                    colored("FAIL", "red"), f"Invalid qubit count {new_circ.n_qubits}"
+            if n_qubits != old_circ.n_qubits:
+                log.append(
+                    line + colored("FAIL", "red") + f" Invalid qubit count {n_qubits}"
                 )
                 n_fail += 1
                 continue
 
-            if new_circ.n_qubits > max_qubits:
-                print(colored("Skip", "yellow"))
+            if n_qubits > max_qubits:
+                log.append(line + colored("Skip", "yellow"))
                 n_skipped += 1
                 continue
-            start_time = time.time()
-            is_eq = test_equivalence(new_circ, old_circ)
-            end_time = time.time()
-            elapsed_time = end_time - start_time
+
             if is_eq:
-                print(colored("OK", "green"), f"({elapsed_time:.2f}s)")
+                log.append(line + colored("OK", "green") + f" ({elapsed_time:.2f}s)")
                 n_success += 1
+            elif early_exit:
+                # The contraction was given up, the candidate is not proven
+                # to differ
+                log.append(
+                    line
+                    + colored("Inconclusive", "magenta")
+                    + f" ({elapsed_time:.2f}s, early exit)"
+                )
+                n_inconclusive += 1
+                is_eq = None
             else:
-                print(colored("FAIL", "red"), f"({elapsed_time:.2f}s)")
+                log.append(line + colored("FAIL", "red") + f" ({elapsed_time:.2f}s)")
                 n_fail += 1
 
-            results.append((name, is_eq, elapsed_time))
+            results.append((name, is_eq, elapsed_time, early_exit))
+
+        print("\n".join(log), flush=True)
+
+        contractor.free()
 
-    global_time = time.time() - global_start_time
+    global_time = time.perf_counter() - global_start_time
 
     print(
-        f"Finished in {global_time:.2f}s. Success/Fail/Skipped (" +
+        f"Finished in {global_time:.2f}s. Success/Fail/Inconclusive/Skipped (" +
         colored(n_success, "green") +
         "/" +
         colored(n_fail, "red") +
         "/" +
+        colored(n_inconclusive, "magenta") +
+        "/" +
         colored(n_skipped, "yellow") +
         ")."
     )
 
 
-def load_circuit(file):
-    """Load a circuit from a tket1 json or qasm file."""
+def _read_circuit_file(file):
+    """Read a tket1 json or qasm file and its qubit count, without loading it.
+
+    Returns `(n_qubits, data)`, where `data` is the parsed json or the qasm
+    text, which `load_circuit` accepts so that the file is parsed only once.
+    """
     file = Path(file)
+    if file.suffix == ".json":
+        data = orjson.loads(file.read_bytes())
+        return len(data["qubits"]), data
+    elif file.suffix == ".qasm":
+        data = file.read_text()
+        return sum(int(size) for size in _QREG_RE.findall(data)), data
+    else:
+        raise ValueError(f"Unknown file extension: {file.suffix}")
+
+
+def load_circuit(file, data=None):
+    """Load a circuit from a tket1 json or qasm file.
+
+    `data` is the content of the file from `_read_circuit_file`, if it has
+    already been read.
+    """
+    from pytket import Circuit
+    from pytket.qasm import circuit_from_qasm_str
+
+    file = Path(file)
+    if data is None:
+        _, data = _read_circuit_file(file)
     # Check the extension
     if file.suffix == ".json":
-        with open(file, "r") as f:
-            json_circ = json.load(f)
-            # Ignore classical registers
-            json_circ["bits"] = []
-            circ = Circuit.from_dict(json_circ)
+        # Ignore classical registers
+        data["bits"] = []
+        circ = Circuit.from_dict(data)
     elif file.suffix == ".qasm":
-        with open(file, "r") as f:
-            # Ignore classical registers
-            qasm = "".join(line for line in f if "creg" not in line)
-            circ = circuit_from_qasm_str(qasm)
+        # Ignore classical registers
+        qasm = _CREG_RE.sub("", data)
+        circ = circuit_from_qasm_str(qasm)
     else:
         raise ValueError(f"Unknown file extension: {file.suffix}")
 
@@ -134,18 +883,23 @@ def load_circuit(file):
 
 if __name__ == "__main__":
     import csv
+    import sys
+
+    # Output is printed and flushed in blocks, once per reference circuit, so
+    # there is no need to flush every line
+    sys.stdout.reconfigure(line_buffering=False)
 
     results = []
 
     MAX_QUBITS = 40
 
-    print("Starting")
+    print("Starting", flush=True)
     try:
         run(MAX_QUBITS, results)
     finally:
         # Save results to CSV file
         with open("results.csv", "w", newline="") as f:
             writer = csv.writer(f)
-            writer.writerow(["Name", "Success", "Elapsed Time"])
+            writer.writerow(["Name", "Success", "Elapsed Time", "Early Exit"])
             for row in results:
                 writer.writerow(row)